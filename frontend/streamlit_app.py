@@ -1,9 +1,11 @@
 import streamlit as st
-import requests
+import httpx
 import json
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Callable
 import time
+from collections import deque
 from datetime import datetime
+from itertools import islice
 
 # Page configuration
 st.set_page_config(
@@ -14,7 +16,7 @@ st.set_page_config(
 )
 
 # Custom CSS for modern styling
-st.markdown("""
+CUSTOM_CSS = """
 <style>
     /* Main container styling */
     .main {
@@ -180,11 +182,44 @@ st.markdown("""
     footer {visibility: hidden;}
     header {visibility: hidden;}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+EXAMPLE_QUERIES = {
+    "Analytics": [
+        "What is the total turnover by country?",
+        "Show me products with turnover greater than 1.0",
+        "What is the average turnover by segment?"
+    ],
+    "Semantic": [
+        "How do I play Lucky 7 Slots?",
+        "What are the payout rules for Roulette Pro?",
+        "Explain the wild symbol mechanics"
+    ],
+    "General": [
+        "What makes a good casino game?",
+        "How do you measure game performance?"
+    ]
+}
+
+QUERY_TYPE_BADGES = {
+    "analytics": '<div class="query-badge analytics-badge">📊 Analytics Query</div>',
+    "semantic": '<div class="query-badge semantic-badge">📚 Semantic Query</div>',
+    "general": '<div class="query-badge general-badge">💡 General Query</div>'
+}
+# Question length bounds enforced by the API
+MIN_QUESTION_LENGTH = 3
+MAX_QUESTION_LENGTH = 1000
+
+# Number of past queries kept in the session
+MAX_HISTORY_ITEMS = 20
+
+DEFAULT_QUERY_TYPE_BADGE = '<div class="query-badge general-badge">General Query</div>'
+
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # Initialize session state
 if 'query_history' not in st.session_state:
-    st.session_state.query_history = []
+    st.session_state.query_history = deque(maxlen=MAX_HISTORY_ITEMS)
 if 'current_response' not in st.session_state:
     st.session_state.current_response = None
 if 'loading' not in st.session_state:
@@ -193,25 +228,78 @@ if 'loading' not in st.session_state:
 # API configuration
 API_URL = st.secrets.get("API_URL", "http://localhost:8000")
 
-def make_api_request(question: str, persona: str, model: str) -> Optional[Dict[str, Any]]:
-    """Make API request to the backend service."""
+# Seconds an API health result is reused before asking the backend again
+HEALTH_CHECK_TTL = 30
+
+@st.cache_resource
+def get_client() -> httpx.Client:
+    """Shared keep-alive HTTP client, reused across reruns and sessions."""
+    return httpx.Client(
+        base_url=API_URL,
+        timeout=httpx.Timeout(10.0, read=60.0),
+        limits=httpx.Limits(max_keepalive_connections=8)
+    )
+
+@st.cache_data(ttl=HEALTH_CHECK_TTL)
+def check_health() -> Optional[Dict[str, Any]]:
+    """Fetch the backend health status, cached briefly so reruns don't each hit the API."""
     try:
-        response = requests.post(
-            f"{API_URL}/query",
+        response = get_client().get("/health", timeout=5)
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return {"status": "unreachable"}
+    return response.json()
+
+def make_api_request(question: str, persona: str, model: str,
+                     on_token: Optional[Callable[[str], None]] = None) -> Optional[Dict[str, Any]]:
+    """Stream the answer from the backend service, reporting partial answers via on_token."""
+    response = {"question": question, "answer": ""}
+    try:
+        with get_client().stream(
+            "POST",
+            "/query/stream",
             json={
                 "question": question,
                 "persona": persona,
                 "model": model
-            },
-            headers={"Content-Type": "application/json"},
-            timeout=60
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+            }
+        ) as stream:
+            stream.raise_for_status()
+            for line in stream.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                
+                if event["type"] == "meta":
+                    response["query_type"] = event["query_type"]
+                elif event["type"] == "token":
+                    response["answer"] += event["delta"]
+                    if on_token:
+                        on_token(response["answer"])
+                elif event["type"] == "error":
+                    st.error(f"API Error: {event['error']}")
+                    return None
+                else:  # done
+                    response.update({k: v for k, v in event.items() if k != "type"})
+        return response
+    except httpx.HTTPError as e:
         st.error(f"API Error: {str(e)}")
         return None
 
+def set_example_query(query: str):
+    """Example button callback, runs before the rerun so the question box is prefilled on it."""
+    st.session_state.example_query = query
+
+def history_response(response: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a response for the query history, keeping only the titles of retrieved context."""
+    if not response.get("context"):
+        return response
+    return {
+        **response,
+        "context": [{"title": ctx.get("title", "Unknown")} for ctx in response["context"]]
+    }
+
 def display_loading_animation():
     """Display a custom loading animation."""
     loading_placeholder = st.empty()
@@ -227,12 +315,7 @@ def display_loading_animation():
 
 def get_query_type_badge(query_type: str) -> str:
     """Get HTML for query type badge."""
-    badges = {
-        "analytics": '<div class="query-badge analytics-badge">📊 Analytics Query</div>',
-        "semantic": '<div class="query-badge semantic-badge">📚 Semantic Query</div>',
-        "general": '<div class="query-badge general-badge">💡 General Query</div>'
-    }
-    return badges.get(query_type, '<div class="query-badge general-badge">General Query</div>')
+    return QUERY_TYPE_BADGES.get(query_type, DEFAULT_QUERY_TYPE_BADGE)
 
 def display_response(response: Dict[str, Any]):
     """Display the API response in a structured format."""
@@ -267,6 +350,78 @@ def display_response(response: Dict[str, Any]):
         st.markdown("### Query Results")
         st.json(response["results"])
 
+@st.fragment
+def response_panel(persona: str, model: str):
+    """Question input and response display, rerun on its own when its widgets change."""
+    st.markdown("### Ask Your Question")
+    st.info("ℹ️ SQL and RAG queries are multi-step workflows. It may take up to 40 seconds to get a final response. Please be patient.")
+    
+    # Query input
+    default_query = st.session_state.get('example_query', '')
+    question = st.text_area(
+        "Enter your question",
+        value=default_query,
+        height=120,
+        max_chars=MAX_QUESTION_LENGTH,
+        placeholder="Ask about game analytics, rules, or general gaming questions...",
+        help="Type your question here"
+    )
+    
+    # Submit button
+    if st.button("Submit Query", type="primary", disabled=st.session_state.loading):
+        if len(question.strip()) >= MIN_QUESTION_LENGTH:
+            st.session_state.loading = True
+            loading_placeholder = display_loading_animation()
+            answer_placeholder = st.empty()
+            
+            def render_partial_answer(answer: str):
+                loading_placeholder.empty()
+                answer_placeholder.markdown(f'<div class="markdown-content">{answer}</div>', unsafe_allow_html=True)
+            
+            # Make API request, rendering the answer as it streams in
+            response = make_api_request(question, persona, model, on_token=render_partial_answer)
+            
+            # Clear loading animation and partial answer
+            loading_placeholder.empty()
+            answer_placeholder.empty()
+            st.session_state.loading = False
+            
+            if response:
+                st.session_state.current_response = response
+                st.session_state.query_history.append({
+                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "question": question,
+                    "response": history_response(response)
+                })
+                
+                # Clear example query
+                if 'example_query' in st.session_state:
+                    del st.session_state.example_query
+                
+                # Refresh the whole page so the sidebar history picks up the new entry
+                st.rerun()
+        else:
+            st.warning(f"Please enter a question of at least {MIN_QUESTION_LENGTH} characters")
+    
+    
+    # Display response
+    if st.session_state.current_response and not st.session_state.loading:
+        display_response(st.session_state.current_response)
+
+@st.fragment(run_every=HEALTH_CHECK_TTL)
+def api_status():
+    """API status indicator, refreshed on a timer instead of on every rerun."""
+    st.markdown("### API Status")
+    health_data = check_health()
+    if health_data is None:
+        st.error("❌ API Offline")
+    elif health_data.get("status") == "healthy":
+        st.success("✅ API Connected")
+    elif health_data.get("status") == "unreachable":
+        st.error("❌ API Unreachable")
+    else:
+        st.error("❌ API Unhealthy")
+
 def main():
     # Header
     st.markdown("""
@@ -303,81 +458,22 @@ def main():
         
         # Example queries
         st.markdown("### Example Queries")
-        example_queries = {
-            "Analytics": [
-                "What is the total turnover by country?",
-                "Show me products with turnover greater than 1.0",
-                "What is the average turnover by segment?"
-            ],
-            "Semantic": [
-                "How do I play Lucky 7 Slots?",
-                "What are the payout rules for Roulette Pro?",
-                "Explain the wild symbol mechanics"
-            ],
-            "General": [
-                "What makes a good casino game?",
-                "How do you measure game performance?"
-            ]
-        }
-        
-        for category, queries in example_queries.items():
+        example_index = 0
+        for category, queries in EXAMPLE_QUERIES.items():
             with st.expander(f"{category} Queries"):
                 for query in queries:
-                    if st.button(query, key=f"example_{query}"):
-                        st.session_state.example_query = query
+                    st.button(query, key=f"example_{example_index}", on_click=set_example_query, args=(query,))
+                    example_index += 1
         
     
     with col2:
-        st.markdown("### Ask Your Question")
-        st.info("ℹ️ SQL and RAG queries are multi-step workflows. It may take up to 40 seconds to get a final response. Please be patient.")
-        
-        # Query input
-        default_query = st.session_state.get('example_query', '')
-        question = st.text_area(
-            "Enter your question",
-            value=default_query,
-            height=120,
-            placeholder="Ask about game analytics, rules, or general gaming questions...",
-            help="Type your question here"
-        )
-        
-        # Submit button
-        if st.button("Submit Query", type="primary", disabled=st.session_state.loading):
-            if question.strip():
-                st.session_state.loading = True
-                loading_placeholder = display_loading_animation()
-                
-                # Make API request
-                response = make_api_request(question, persona, model)
-                
-                # Clear loading animation
-                loading_placeholder.empty()
-                st.session_state.loading = False
-                
-                if response:
-                    st.session_state.current_response = response
-                    st.session_state.query_history.append({
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "question": question,
-                        "response": response
-                    })
-                    
-                    # Clear example query
-                    if 'example_query' in st.session_state:
-                        del st.session_state.example_query
-            else:
-                st.warning("Please enter a question")
-        
-        
-        # Display response
-        if st.session_state.current_response and not st.session_state.loading:
-            display_response(st.session_state.current_response)
+        response_panel(persona, model)
     
     # Query History (in sidebar)
     with st.sidebar:
         st.markdown("### Query History")
         if st.session_state.query_history:
-            for i, item in enumerate(reversed(st.session_state.query_history[-5:])):
+            for i, item in enumerate(islice(reversed(st.session_state.query_history), 5)):
                 with st.expander(f"{item['timestamp']} - {item['question'][:50]}..."):
                     if st.button(f"Load Query {i}", key=f"history_{i}"):
                         st.session_state.current_response = item['response']
@@ -386,19 +482,7 @@ def main():
             st.info("No queries yet")
         
         # API Status
-        st.markdown("### API Status")
-        try:
-            health_response = requests.get(f"{API_URL}/health", timeout=5)
-            if health_response.status_code == 200:
-                health_data = health_response.json()
-                if health_data.get("status") == "healthy":
-                    st.success("✅ API Connected")
-                else:
-                    st.error("❌ API Unhealthy")
-            else:
-                st.error("❌ API Unreachable")
-        except:
-            st.error("❌ API Offline")
+        api_status()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
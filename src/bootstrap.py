@@ -0,0 +1,45 @@
+import os
+from dotenv import load_dotenv
+
+from src.database import DatabaseManager
+from src.rag_service import RAGService, USE_BATCH_API
+
+# Load environment variables
+load_dotenv()
+
+def prepare_database(db_path: str = "db/products.db"):
+    """Create and load the products database if it does not exist yet.
+
+    The database is built under a temporary name and renamed into place, so a worker
+    never opens a half-loaded file.
+    """
+    if os.path.exists(db_path):
+        return
+
+    print("Initializing database...")
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    db_manager = DatabaseManager(tmp_path)
+    try:
+        db_manager.create_schema()
+        db_manager.load_data()
+    finally:
+        db_manager.close()
+    os.replace(tmp_path, db_path)
+
+def prepare_data(use_batch_api: bool = False):
+    """One-time setup, run once before the API workers start.
+
+    Workers only read the products database and the Chroma store; running this in each
+    of them would load the database and embed the corpus once per worker. The corpus is
+    embedded directly by default: a Batch API job can take hours, and the server would
+    not accept connections until it finished.
+    """
+    prepare_database()
+    RAGService().ensure_data_loaded(use_batch_api=use_batch_api)
+
+if __name__ == "__main__":
+    # Standalone runs are offline ingests, so they may use the Batch API (RAG_USE_BATCH_API)
+    prepare_data(use_batch_api=USE_BATCH_API)
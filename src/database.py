@@ -1,12 +1,75 @@
 import sqlite3
+import threading
 import pandas as pd
 import os
 from pathlib import Path
+from typing import List, Dict, Any
 
 class DatabaseManager:
     def __init__(self, db_path: str = "db/products.db"):
         self.db_path = db_path
+        self._conn = None
+        self._mem = None
+        self._lock = threading.RLock()
         self.ensure_db_directory()
+    
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Writable connection to the database file, opened on first use by the setup code."""
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA mmap_size=268435456")
+                conn.execute("PRAGMA cache_size=-65536")
+                self._conn = conn
+            return self._conn
+    
+    @property
+    def memory_connection(self) -> sqlite3.Connection:
+        """In-memory copy of the database for reads, loaded from the file on first use."""
+        with self._lock:
+            if self._mem is None:
+                mem = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+                if self._conn is not None:
+                    self._conn.backup(mem)
+                else:
+                    # Read-only and without pragmas, so reading never rewrites the file header
+                    source = sqlite3.connect(f"{Path(self.db_path).resolve().as_uri()}?mode=ro", uri=True)
+                    try:
+                        source.backup(mem)
+                    finally:
+                        source.close()
+                self._mem = mem
+            return self._mem
+    
+    def _refresh_memory_copy(self):
+        """Copy the database file into the in-memory copy again after a write."""
+        with self._lock:
+            if self._mem is not None:
+                self.connection.backup(self._mem)
+    
+    def execute_read(self, query: str) -> List[Dict[str, Any]]:
+        """Run a query against the in-memory copy and return the rows as dicts."""
+        with self._lock:
+            cursor = self.memory_connection.execute(query)
+            if cursor.description is None:
+                return []
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def close(self):
+        """Close the shared connections."""
+        with self._lock:
+            # Leave a written file in rollback-journal mode, so readers can open it read-only
+            if self._conn is not None:
+                self._conn.execute("PRAGMA journal_mode=DELETE")
+            for conn in (self._conn, self._mem):
+                if conn is not None:
+                    conn.close()
+            self._conn = None
+            self._mem = None
         
     def ensure_db_directory(self):
         """Create database directory if it doesn't exist."""
@@ -16,71 +79,83 @@ class DatabaseManager:
     
     def create_schema(self):
         """Create the products table schema."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Drop table if exists for fresh start
-        cursor.execute("DROP TABLE IF EXISTS products")
+        with self._lock:
+            cursor = self.connection.cursor()
+            
+            # Drop table if exists for fresh start
+            cursor.execute("DROP TABLE IF EXISTS products")
+            
+            # Create products table
+            cursor.execute("""
+                CREATE TABLE products (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    description TEXT,
+                    turnover REAL,
+                    launch_date DATE,
+                    country TEXT,
+                    segment TEXT
+                )
+            """)
+            self._refresh_memory_copy()
         
-        # Create products table
-        cursor.execute("""
-            CREATE TABLE products (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT,
-                turnover REAL,
-                launch_date DATE,
-                country TEXT,
-                segment TEXT
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
         print("Schema created successfully!")
     
     def load_data(self, csv_path: str = "data/csv/products.csv"):
-        """Load data from CSV into the database."""
+        """Load data from CSV into the products table created by create_schema."""
         # Read CSV
         df = pd.read_csv(csv_path)
         
         # Convert launch_date to proper date format
-        df['launch_date'] = pd.to_datetime(df['launch_date'], format='%d/%m/%Y')
+        df['launch_date'] = pd.to_datetime(df['launch_date'], format='%d/%m/%Y').dt.strftime('%Y-%m-%d')
         
-        # Connect to database
-        conn = sqlite3.connect(self.db_path)
+        columns = ", ".join(df.columns)
+        placeholders = ", ".join("?" for _ in df.columns)
+        rows = list(df.itertuples(index=False, name=None))
         
-        # Load data into products table
-        df.to_sql('products', conn, if_exists='replace', index=False)
+        # Replace the products table contents in a single transaction
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN")
+            try:
+                conn.execute("DELETE FROM products")
+                conn.executemany(f"INSERT INTO products ({columns}) VALUES ({placeholders})", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._refresh_memory_copy()
         
-        conn.close()
         print(f"Loaded {len(df)} records into the database!")
     
+    def ping(self) -> int:
+        """Quiet connection check for periodic health probes; returns the product count."""
+        with self._lock:
+            return self.memory_connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    
     def test_connection(self):
         """Test database connection and show sample data."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get table info
-        cursor.execute("PRAGMA table_info(products)")
-        columns = cursor.fetchall()
-        print("\nTable Schema:")
-        for col in columns:
-            print(f"  {col[1]} ({col[2]})")
-        
-        # Get sample data
-        cursor.execute("SELECT * FROM products LIMIT 5")
-        rows = cursor.fetchall()
-        print("\nSample Data:")
-        for row in rows:
-            print(f"  {row}")
-        
-        # Get statistics
-        cursor.execute("SELECT COUNT(*) FROM products")
-        count = cursor.fetchone()[0]
-        print(f"\nTotal records: {count}")
-        
-        conn.close()
+        with self._lock:
+            cursor = self.memory_connection.cursor()
+            
+            # Get table info
+            cursor.execute("PRAGMA table_info(products)")
+            columns = cursor.fetchall()
+            print("\nTable Schema:")
+            for col in columns:
+                print(f"  {col[1]} ({col[2]})")
+            
+            # Get sample data
+            cursor.execute("SELECT * FROM products LIMIT 5")
+            rows = cursor.fetchall()
+            print("\nSample Data:")
+            for row in rows:
+                print(f"  {row}")
+            
+            # Get statistics
+            cursor.execute("SELECT COUNT(*) FROM products")
+            count = cursor.fetchone()[0]
+            print(f"\nTotal records: {count}")
 
 if __name__ == "__main__":
     # Initialize database
@@ -1,9 +1,16 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, Literal, List
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, StringConstraints
+from typing import Optional, Dict, Any, Literal, List, AsyncIterator, Annotated, Tuple
 import os
+import json
+import hashlib
 from dotenv import load_dotenv
 import asyncio
+from contextlib import asynccontextmanager
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
 
 from src.database import DatabaseManager
 from src.sql_agent import SQLQueryAgent
@@ -13,23 +20,97 @@ from src.query_router import QueryRouter
 # Load environment variables
 load_dotenv()
 
+# Streaming batch configuration: flush when the batch is full or the timeout elapses,
+# growing the batch size geometrically from the minimum up to the maximum
+DEFAULT_MIN_BATCH_SIZE = int(os.getenv("STREAM_MIN_BATCH_SIZE", "1"))
+DEFAULT_BATCH_SIZE = int(os.getenv("STREAM_MAX_BATCH_SIZE", "50"))
+DEFAULT_BATCH_SIZE_GROWTH_FACTOR = int(os.getenv("STREAM_BATCH_SIZE_GROWTH_FACTOR", "3"))
+DEFAULT_BATCH_TIMEOUT = float(os.getenv("STREAM_BATCH_TIMEOUT_MS", "50")) / 1000
+
+# Seconds between background health probes of the database and RAG store
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))
+
+# Services, created per worker process by the lifespan handler
+db_manager: Optional[DatabaseManager] = None
+sql_agent: Optional[SQLQueryAgent] = None
+rag_service: Optional[RAGService] = None
+query_router: Optional[QueryRouter] = None
+
+# Latest background health probe result, served as-is by /health
+health_status: Dict[str, Any] = {"status": "starting"}
+
+def probe_health() -> Dict[str, Any]:
+    """Check the database and RAG service connections."""
+    try:
+        # Test database connection
+        db_manager.ping()
+        # Test RAG service
+        rag_service.test_connection()
+        return {"status": "healthy", "database": "connected", "rag": "connected"}
+    except Exception as e:
+        return {"status": "unhealthy", "error": str(e)}
+
+async def monitor_health():
+    """Refresh health_status periodically so /health never probes the backends inline."""
+    global health_status
+    while True:
+        health_status = await asyncio.to_thread(probe_health)
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the services when a worker starts; the data is prepared once by src.bootstrap."""
+    global db_manager, sql_agent, rag_service, query_router
+    
+    db_manager = DatabaseManager()
+    if not os.path.exists(db_manager.db_path):
+        raise RuntimeError(f"{db_manager.db_path} not found; run `python -m src.bootstrap` first")
+    
+    # Initialize services
+    sql_agent = SQLQueryAgent(db_manager)
+    rag_service = RAGService()
+    query_router = QueryRouter()
+    
+    # Open the vector store in the background so startup does not wait on it
+    warm_up_task = asyncio.create_task(asyncio.to_thread(rag_service.warm_up))
+    health_task = asyncio.create_task(monitor_health())
+    
+    yield
+    
+    health_task.cancel()
+    warm_up_task.cancel()
+    db_manager.close()
+
 # Initialize FastAPI app
-app = FastAPI(title="Hybrid RAG & Analytics Service")
+app = FastAPI(title="Hybrid RAG & Analytics Service", lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# General answer prompts, compiled once and shared across requests
+general_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3, max_tokens=400)
+
+PERSONA_CONTEXT = {
+    "product_owner": "You are a technical product owner focused on system architecture and performance.",
+    "marketing": "You are a marketing specialist focused on user engagement and conversion."
+}
 
-# Initialize database if needed
-db_manager = DatabaseManager()
-if not os.path.exists("db/products.db"):
-    print("Initializing database...")
-    db_manager.create_schema()
-    db_manager.load_data()
+general_prompts = {
+    persona: ChatPromptTemplate.from_messages([
+        ("system", f"{context} Answer the user's question helpfully and concisely."),
+        ("human", "{question}")
+    ])
+    for persona, context in PERSONA_CONTEXT.items()
+}
 
-# Initialize services
-sql_agent = SQLQueryAgent()
-rag_service = RAGService()
-query_router = QueryRouter()
+# Questions outside these bounds are rejected with a 422 before any LLM call
+MIN_QUESTION_LENGTH = 3
+MAX_QUESTION_LENGTH = 1000
 
 class QueryRequest(BaseModel):
-    question: str
+    question: Annotated[str, StringConstraints(
+        strip_whitespace=True,
+        min_length=MIN_QUESTION_LENGTH,
+        max_length=MAX_QUESTION_LENGTH
+    )]
     persona: Optional[Literal["product_owner", "marketing"]] = "product_owner"
 
 class QueryResponse(BaseModel):
@@ -41,12 +122,69 @@ class QueryResponse(BaseModel):
     context: Optional[List[Dict[str, str]]] = None
     error: Optional[str] = None
 
+EXAMPLES = {
+    "examples": {
+        "analytics": [
+            {
+                "question": "What is the total turnover by country?",
+                "persona": "product_owner",
+                "description": "SQL aggregation query with technical response"
+            },
+            {
+                "question": "Show me products with turnover greater than 1.0 in Belgium",
+                "persona": "marketing",
+                "description": "Filtered query with marketing-focused response"
+            },
+            {
+                "question": "What is the average turnover by segment over the past 7 days?",
+                "persona": "product_owner",
+                "description": "Time-based aggregation with technical insights"
+            }
+        ],
+        "semantic": [
+            {
+                "question": "How do I play Lucky 7 Slots?",
+                "persona": "marketing",
+                "description": "Game rules query with user-friendly explanation"
+            },
+            {
+                "question": "What are the payout rules for Roulette Pro?",
+                "persona": "product_owner",
+                "description": "Technical game mechanics query"
+            },
+            {
+                "question": "Explain the wild symbol mechanics in slot games",
+                "persona": "product_owner",
+                "description": "Cross-game feature explanation"
+            }
+        ],
+        "general": [
+            {
+                "question": "What makes a good casino game?",
+                "persona": "marketing",
+                "description": "General gaming industry question"
+            },
+            {
+                "question": "How do you measure game performance?",
+                "persona": "product_owner",
+                "description": "General analytics question"
+            }
+        ]
+    }
+}
+
+# The examples never change at runtime, so serialize them and compute the ETag once
+EXAMPLES_BODY = json.dumps(EXAMPLES).encode()
+EXAMPLES_ETAG = f'"{hashlib.md5(EXAMPLES_BODY).hexdigest()}"'
+EXAMPLES_HEADERS = {"ETag": EXAMPLES_ETAG, "Cache-Control": "max-age=3600"}
+
 @app.get("/")
 def read_root():
     return {
         "service": "Hybrid RAG & Analytics Service",
         "endpoints": {
             "/query": "POST - Process natural language queries with intelligent routing",
+            "/query/stream": "POST - Same as /query, streaming the answer as server-sent events",
             "/health": "GET - Health check",
             "/examples": "GET - Example queries"
         }
@@ -54,206 +192,174 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    try:
-        # Test database connection
-        db_manager.test_connection()
-        # Test RAG service
-        rag_service.test_connection()
-        return {"status": "healthy", "database": "connected", "rag": "connected"}
-    except Exception as e:
-        return {"status": "unhealthy", "error": str(e)}
+    return health_status
 
 @app.post("/query", response_model=QueryResponse)
 async def process_query(request: QueryRequest):
     """Process a natural language query with intelligent routing."""
     try:
-        # Determine query type
-        query_type = await query_router.classify_query(request.question)
+        response = {"question": request.question}
+        answer_parts = []
         
-        response = {
-            "question": request.question,
-            "query_type": query_type,
-        }
-        
-        if query_type == "analytics":
-            # Use SQL agent for analytics queries
-            sql_result = sql_agent.process_query(request.question)
-            
-            # Apply persona to the answer
-            personalized_answer = await apply_persona(
-                sql_result["answer"],
-                request.persona,
-                query_type,
-                request.question
-            )
-            
-            response.update({
-                "answer": personalized_answer,
-                "sql_query": sql_result["sql_query"],
-                "results": parse_sql_results(sql_result.get("raw_results", ""))
-            })
-            
-        elif query_type == "semantic":
-            # Use RAG for semantic queries
-            rag_result = await rag_service.query_with_persona(
-                request.question,
-                request.persona
-            )
-            
-            response.update({
-                "answer": rag_result["answer"],
-                "context": [
-                    {
-                        "title": doc.metadata.get("title", "Unknown"),
-                        "content": doc.page_content[:200] + "..."
-                    }
-                    for doc in rag_result.get("context", [])[:3]
-                ]
-            })
-            
-        else:  # general
-            # Generate a general response
-            general_answer = await generate_general_response(
-                request.question,
-                request.persona
-            )
-            response["answer"] = general_answer
+        async for event in query_events(request):
+            if event["type"] == "meta":
+                response["query_type"] = event["query_type"]
+            elif event["type"] == "token":
+                answer_parts.append(event["delta"])
+            else:  # done
+                response.update({k: v for k, v in event.items() if k != "type"})
         
+        response["answer"] = "".join(answer_parts)
         return QueryResponse(**response)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def apply_persona(answer: str, persona: str, query_type: str, question: str) -> str:
-    """Apply persona styling to the answer."""
-    from langchain_openai import ChatOpenAI
-    from langchain_core.prompts import ChatPromptTemplate
-    
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=1)
+@app.post("/query/stream")
+async def stream_query(request: QueryRequest):
+    """Process a query and stream the answer as server-sent events."""
+    async def event_stream():
+        try:
+            async for event in query_events(request):
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
     
-    persona_prompts = {
-        "product_owner": """You are a technical product owner. Rewrite this answer to:
-        - Emphasize system architecture and technical implementation details
-        - Discuss performance implications and trade-offs
-        - Include metrics and data-driven insights
-        - Use technical terminology appropriately
-        - Focus on scalability and system design considerations""",
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+async def query_events(request: QueryRequest) -> AsyncIterator[Dict[str, Any]]:
+    """Route a query and yield meta, token and done events as the answer is produced."""
+    # Determine query type, prefetching RAG context while the LLM classifier runs
+    context = None
+    query_type = query_router.peek(request.question)
+    if query_type is None:
+        prefetch = asyncio.create_task(rag_service.aretrieve(request.question))
+        prefetch.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            query_type = await query_router.classify_query(request.question)
+        except BaseException:
+            prefetch.cancel()
+            raise
         
-        "marketing": """You are a marketing specialist. Rewrite this answer to:
-        - Highlight user experience and engagement metrics
-        - Focus on conversion rates and customer value
-        - Use persuasive and accessible language
-        - Emphasize benefits and opportunities
-        - Include actionable insights for marketing strategies"""
-    }
+        if query_type == "semantic":
+            context = await prefetch
+        else:
+            prefetch.cancel()
     
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", persona_prompts.get(persona, persona_prompts["product_owner"])),
-        ("human", f"Original question: {question}\n\nOriginal answer: {answer}\n\nRewrite this answer according to your persona.")
-    ])
+    yield {"type": "meta", "question": request.question, "query_type": query_type}
     
-    response = await llm.ainvoke(prompt.format())
-    return response.content
-
-async def generate_general_response(question: str, persona: str) -> str:
-    """Generate a general response for non-specific queries."""
-    from langchain_openai import ChatOpenAI
-    from langchain_core.prompts import ChatPromptTemplate
+    done = {"type": "done"}
     
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=1)
+    if query_type == "analytics":
+        # Use SQL agent for analytics queries, answering in the persona's voice
+        sql_result = {}
+        async for delta in batch_tokens(answer_tokens(
+            sql_agent.astream_query(request.question, request.persona),
+            sql_result
+        )):
+            yield {"type": "token", "delta": delta}
+        
+        done.update({
+            "sql_query": sql_result["sql_query"],
+            "results": sql_result.get("raw_results") or None
+        })
+        
+    elif query_type == "semantic":
+        # Use RAG for semantic queries
+        rag_result = {}
+        async for delta in batch_tokens(answer_tokens(
+            rag_service.astream_with_persona(request.question, request.persona, context=context),
+            rag_result
+        )):
+            yield {"type": "token", "delta": delta}
+        
+        done["context"] = [
+            {
+                "title": doc.metadata.get("title", "Unknown"),
+                "content": doc.page_content[:200] + "..."
+            }
+            for doc in rag_result.get("context", [])[:3]
+        ]
+        
+    else:  # general
+        # Generate a general response
+        async for delta in batch_tokens(generate_general_response(
+            request.question,
+            request.persona
+        )):
+            yield {"type": "token", "delta": delta}
     
-    persona_context = {
-        "product_owner": "You are a technical product owner focused on system architecture and performance.",
-        "marketing": "You are a marketing specialist focused on user engagement and conversion."
-    }
+    yield done
+
+async def answer_tokens(events: AsyncIterator[Tuple[str, Any]], result: Dict[str, Any]) -> AsyncIterator[str]:
+    """Yield the token deltas of a service stream, storing its final result in result."""
+    async for kind, value in events:
+        if kind == "token":
+            yield value
+        else:
+            result.update(value)
+
+async def batch_tokens(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Coalesce streamed tokens so each frame carries a growing batch instead of a single token."""
+    loop = asyncio.get_running_loop()
+    iterator = tokens.__aiter__()
+    max_batch = DEFAULT_MIN_BATCH_SIZE
+    buf = []
+    deadline = loop.time() + DEFAULT_BATCH_TIMEOUT
+    next_token = asyncio.ensure_future(iterator.__anext__())
     
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", f"{persona_context.get(persona, persona_context['product_owner'])} Answer the user's question helpfully and concisely."),
-        ("human", "{question}")
-    ])
+    try:
+        while True:
+            remaining = max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_token}, timeout=remaining)
+            if next_token in done:
+                try:
+                    buf.append(next_token.result())
+                except StopAsyncIteration:
+                    break
+                next_token = asyncio.ensure_future(iterator.__anext__())
+            
+            if loop.time() < deadline and len(buf) < max_batch:
+                continue
+            
+            if buf:
+                yield "".join(buf)
+                buf = []
+                max_batch = min(max_batch * DEFAULT_BATCH_SIZE_GROWTH_FACTOR, DEFAULT_BATCH_SIZE)
+            deadline = loop.time() + DEFAULT_BATCH_TIMEOUT
+    finally:
+        next_token.cancel()
     
-    response = await llm.ainvoke(prompt.format(question=question))
-    return response.content
+    if buf:
+        yield "".join(buf)
 
-def parse_sql_results(raw_results: str) -> Optional[List[Dict]]:
-    """Parse SQL results into structured format."""
-    if not raw_results:
-        return None
+async def generate_general_response(question: str, persona: str) -> AsyncIterator[str]:
+    """Generate a general response for non-specific queries, streaming tokens."""
+    prompt = general_prompts.get(persona, general_prompts["product_owner"])
     
-    try:
-        # Simple parsing for common result formats
-        lines = raw_results.strip().split('\n')
-        if len(lines) < 2:
-            return None
-        
-        # Assume first line is headers
-        headers = [h.strip() for h in lines[0].split('|')]
-        results = []
-        
-        for line in lines[1:]:
-            if line.strip():
-                values = [v.strip() for v in line.split('|')]
-                if len(values) == len(headers):
-                    results.append(dict(zip(headers, values)))
-        
-        return results if results else None
-    except:
-        return None
+    async for chunk in general_llm.astream(prompt.format(question=question)):
+        if chunk.content:
+            yield chunk.content
 
 @app.get("/examples")
-def get_examples():
+def get_examples(request: Request):
     """Return example queries to try."""
-    return {
-        "examples": {
-            "analytics": [
-                {
-                    "question": "What is the total turnover by country?",
-                    "persona": "product_owner",
-                    "description": "SQL aggregation query with technical response"
-                },
-                {
-                    "question": "Show me products with turnover greater than 1.0 in Belgium",
-                    "persona": "marketing",
-                    "description": "Filtered query with marketing-focused response"
-                },
-                {
-                    "question": "What is the average turnover by segment over the past 7 days?",
-                    "persona": "product_owner",
-                    "description": "Time-based aggregation with technical insights"
-                }
-            ],
-            "semantic": [
-                {
-                    "question": "How do I play Lucky 7 Slots?",
-                    "persona": "marketing",
-                    "description": "Game rules query with user-friendly explanation"
-                },
-                {
-                    "question": "What are the payout rules for Roulette Pro?",
-                    "persona": "product_owner",
-                    "description": "Technical game mechanics query"
-                },
-                {
-                    "question": "Explain the wild symbol mechanics in slot games",
-                    "persona": "product_owner",
-                    "description": "Cross-game feature explanation"
-                }
-            ],
-            "general": [
-                {
-                    "question": "What makes a good casino game?",
-                    "persona": "marketing",
-                    "description": "General gaming industry question"
-                },
-                {
-                    "question": "How do you measure game performance?",
-                    "persona": "product_owner",
-                    "description": "General analytics question"
-                }
-            ]
-        }
-    }
+    if request.headers.get("if-none-match") == EXAMPLES_ETAG:
+        return Response(status_code=304, headers=EXAMPLES_HEADERS)
+    return Response(content=EXAMPLES_BODY, media_type="application/json", headers=EXAMPLES_HEADERS)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    from src.bootstrap import prepare_data
+    
+    # Load the database and ingest the corpus once, before the workers start
+    prepare_data()
+    uvicorn.run(
+        "src.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        backlog=2048
+    )
\ No newline at end of file
@@ -1,23 +1,49 @@
-from typing import Literal
+import re
+from typing import Literal, Optional
+from cachetools import LRUCache
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel
 
+# Intent keywords (regex fragments) that route a query without asking the LLM
+INTENT_KEYWORDS = {
+    "analytics": [
+        "total", "sum", "average", "count", "how many", "group by", "turnover", "revenue",
+        "segments?", "country", "countries", "greater than", "less than", "launched",
+    ],
+    "semantic": [
+        "play", "payouts?", "rules?", "symbols?", "wilds?", "side bets?", "bonus",
+        "slots?", "roulette", "blackjack", "paylines?", "reels?", "jackpots?",
+    ],
+}
+
+# One compiled alternation per intent, so a single scan finds every keyword hit; each keyword
+# is a named group, so "rule" and "rules" count as one keyword
+INTENT_PATTERNS = {
+    query_type: re.compile(
+        r"\b(?:" + "|".join(f"(?P<k{i}>{keyword})" for i, keyword in enumerate(keywords)) + r")\b",
+        re.IGNORECASE
+    )
+    for query_type, keywords in INTENT_KEYWORDS.items()
+}
+
+# Distinct keyword hits required to route without the LLM
+MIN_KEYWORD_HITS = 2
+
 class QueryClassification(BaseModel):
     query_type: Literal["analytics", "semantic", "general"]
     confidence: float
     reasoning: str
 
 class QueryRouter:
-    def __init__(self, model: str = "gpt-4o-mini"):
+    def __init__(self, model: str = "gpt-4o-mini", cache_size: int = 1024):
         self.llm = ChatOpenAI(model=model, temperature=1)
+        self._cache = LRUCache(maxsize=cache_size)
         
-    async def classify_query(self, question: str) -> str:
-        """Classify query as analytics, semantic, or general."""
-        
-        structured_llm = self.llm.with_structured_output(QueryClassification)
+        # Bind the output schema and build the prompt once, not per query
+        self._structured_llm = self.llm.with_structured_output(QueryClassification)
         
-        classification_prompt = ChatPromptTemplate.from_messages([
+        self._classification_prompt = ChatPromptTemplate.from_messages([
             ("system", """You are a query classifier for a gaming analytics platform.
             
             Classify queries into three categories:
@@ -51,9 +77,42 @@ class QueryRouter:
             - reasoning: Brief explanation of your classification"""),
             ("human", "Classify this query: {question}")
         ])
+    
+    def _fast_classify(self, question: str) -> Optional[str]:
+        """Classify by keyword when one intent clearly dominates, otherwise defer to the LLM."""
+        hits = {
+            query_type: {match.lastgroup for match in pattern.finditer(question)}
+            for query_type, pattern in INTENT_PATTERNS.items()
+        }
+        strong = [query_type for query_type, found in hits.items() if len(found) >= MIN_KEYWORD_HITS]
+        matched = [query_type for query_type, found in hits.items() if found]
+        
+        # Route only when a single intent has enough hits and no other intent matched at all
+        if len(strong) == 1 and matched == strong:
+            return strong[0]
+        return None
+        
+    def peek(self, question: str) -> Optional[str]:
+        """Return the classification if it is known without an LLM call, otherwise None."""
+        key = question.strip().lower()
+        if key in self._cache:
+            return self._cache[key]
+        
+        query_type = self._fast_classify(key)
+        if query_type:
+            print(f"Query: {question}")
+            print(f"Classification: {query_type} (keyword match)")
+            self._cache[key] = query_type
+        return query_type
+        
+    async def classify_query(self, question: str) -> str:
+        """Classify query as analytics, semantic, or general."""
+        query_type = self.peek(question)
+        if query_type:
+            return query_type
         
-        result = await structured_llm.ainvoke(
-            classification_prompt.format(question=question)
+        result = await self._structured_llm.ainvoke(
+            self._classification_prompt.format(question=question)
         )
         
         # Log classification for debugging
@@ -61,4 +120,5 @@ class QueryRouter:
         print(f"Classification: {result.query_type} (confidence: {result.confidence})")
         print(f"Reasoning: {result.reasoning}")
         
+        self._cache[question.strip().lower()] = result.query_type
         return result.query_type
\ No newline at end of file
@@ -1,78 +1,204 @@
 import os
-import uuid
-from typing import List, TypedDict, Dict, Any
+import re
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property
+from itertools import chain
+from typing import List, TypedDict, Dict, Any, Optional, AsyncIterator, Tuple
+import tiktoken
+from cachetools import LRUCache
 from langchain_chroma import Chroma
+from openai import OpenAI
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langgraph.graph import START, StateGraph
 from typing_extensions import TypedDict
 
+# Markdown chunking: chunks are separated by '---' lines and start with a '# Title' line.
+# Byte patterns, so files are scanned through mmap and only kept chunks are decoded.
+CHUNK_SEPARATOR = re.compile(rb'(?m)^---[ \t]*\n')
+CHUNK_TITLE = re.compile(rb'\A# ([^\n]+)\n?(.*)', re.S)
+
+# Embedding model and its reduced output size
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# Texts per embeddings request, and how many requests run at once during ingestion
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_CONCURRENCY = 5
+
+# Opt-in: embed large corpora through the OpenAI Batch API (half price, may take hours).
+# Only honored by offline ingests (python -m src.bootstrap), never at server startup
+USE_BATCH_API = os.getenv("RAG_USE_BATCH_API", "false").lower() == "true"
+BATCH_API_MIN_CHUNKS = 100
+BATCH_API_POLL_INTERVAL = 30
+
+# Retrieval: candidates fetched, minimum relevance for hits after the best one,
+# documents and tokens passed to the LLM
+RETRIEVAL_CANDIDATES = 5
+MIN_RELEVANCE_SCORE = 0.3
+MAX_CONTEXT_DOCS = 3
+MAX_CONTEXT_TOKENS = 2000
+
+PERSONA_PROMPTS = {
+    "product_owner": """You are a technical product owner for a gaming platform. 
+    Focus on system architecture, performance metrics, and technical implementation details.
+    Discuss scalability, data structures, and engineering trade-offs when relevant.""",
+    
+    "marketing": """You are a marketing specialist for a gaming platform.
+    Focus on user experience, engagement metrics, and player satisfaction.
+    Use accessible language and highlight features that drive player retention and monetization."""
+}
+
 class RAGService:
-    def __init__(self):
-        # Initialize OpenAI embeddings and LLM
-        self.embeddings = OpenAIEmbeddings()
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=1)
-        
-        # Initialize Chroma with persistent storage
-        self.persist_directory = "./chroma_db"
-        self.collection_name = "fdj-rag-analytics"
+    def __init__(self, cache_size: int = 1024):
+        # Caches keyed by normalized question: query embedding, and retrieved documents
+        self._query_embedding_cache = LRUCache(maxsize=cache_size)
+        self._retrieval_cache = LRUCache(maxsize=cache_size)
         
-        # Create or load the vector store
-        self.vector_store = Chroma(
-            collection_name=self.collection_name,
-            embedding_function=self.embeddings,
-            persist_directory=self.persist_directory,
-        )
+        # Clients, the vector store and the graph are created on first use;
+        # warm_up() opens the store off the request path; src.bootstrap ingests the corpus
+        self._init_lock = threading.RLock()
+        self._vector_store: Optional[Chroma] = None
+        self._ready = False
         
-        # Initialize data if needed
-        self._ensure_data_loaded()
+        # Chroma persistent storage
+        self.persist_directory = "./chroma_db"
+        # Vectors of different sizes cannot share a collection, so the name carries the dimensions
+        self.collection_name = f"fdj-rag-analytics-{EMBEDDING_DIMENSIONS}"
         
-        # Create RAG app
-        self.rag_app = self._create_rag_app()
+        # Build the answer prompt templates once, one per persona
+        self._answer_prompts = {
+            persona: PromptTemplate.from_template(
+                system_prompt + """
+                
+                Use the following game information to answer the question.
+                If the information doesn't contain the answer, say so clearly.
+                
+                Context:
+                {context}
+                
+                Question: {question}
+                
+                Answer:"""
+            )
+            for persona, system_prompt in PERSONA_PROMPTS.items()
+        }
+    
+    @cached_property
+    def embeddings(self) -> OpenAIEmbeddings:
+        return OpenAIEmbeddings(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+    
+    @cached_property
+    def llm(self) -> ChatOpenAI:
+        return ChatOpenAI(model="gpt-4o-mini", temperature=1)
+    
+    @property
+    def vector_store(self) -> Chroma:
+        # Health probes and warm-up run on different threads; open the store only once.
+        # A plain property, because cached_property holds its own lock while the getter runs
+        if self._vector_store is None:
+            with self._init_lock:
+                if self._vector_store is None:
+                    self._vector_store = Chroma(
+                        collection_name=self.collection_name,
+                        embedding_function=self.embeddings,
+                        persist_directory=self.persist_directory,
+                    )
+        return self._vector_store
+    
+    @cached_property
+    def tokenizer(self) -> tiktoken.Encoding:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    
+    @cached_property
+    def rag_app(self):
+        return self._create_rag_app()
     
-    def _ensure_data_loaded(self):
-        """Ensure data is loaded into vector store."""
+    def warm_up(self):
+        """Open the vector store and warm its index. Safe to call repeatedly."""
+        if self._ready:
+            return
+        with self._init_lock:
+            if not self._ready:
+                self._warm_index()
+                # Load the tokenizer's BPE ranks now rather than on the first answer
+                self.tokenizer
+                self._ready = True
+    
+    def _warm_index(self):
+        """Run one throwaway query so Chroma loads the HNSW index before the first real request."""
+        try:
+            if self.vector_store._collection.count() > 0:
+                self.vector_store._collection.query(
+                    query_embeddings=[[0.0] * EMBEDDING_DIMENSIONS],
+                    n_results=1,
+                    include=[]
+                )
+        except Exception as e:
+            print(f"Could not warm the vector index: {e}")
+    
+    def ensure_data_loaded(self, use_batch_api: bool = USE_BATCH_API):
+        """Ensure data is loaded into vector store.
+        
+        Blocks until the corpus is embedded. Through the Batch API that can take hours,
+        so server startup passes use_batch_api=False.
+        """
         try:
-            test_results = self.vector_store.similarity_search("test", k=1)
-            if not test_results:
+            if self.vector_store._collection.count() == 0:
                 print("RAG collection is empty. Ingesting data...")
-                self._ingest_markdown_files('data/rag')
+                self._ingest_markdown_files('data/rag', use_batch_api)
         except:
             print("RAG collection doesn't exist. Ingesting data...")
-            self._ingest_markdown_files('data/rag')
+            self._ingest_markdown_files('data/rag', use_batch_api)
+    
+    @staticmethod
+    def _chunk_id(path: str, title: str, text: str) -> str:
+        """Deterministic chunk ID from the chunk's source and content, so re-ingesting is idempotent."""
+        digest = hashlib.blake2b(f"{path}|{title}|{text}".encode("utf-8"), digest_size=16).hexdigest()
+        return f"{title.lower().replace(' ', '_')}_{digest}"
     
-    def _chunk_markdown(self, path):
-        """Chunk markdown files by '---' separator."""
-        with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
+    @staticmethod
+    def _chunk_markdown(path):
+        """Chunk markdown files by '---' separator. A staticmethod so worker processes can run it.
         
-        chunks = content.split('---\n')
-        docs = []
+        Returns parallel lists of chunk texts, chunk IDs and metadatas.
+        """
+        texts, ids, metadatas = [], [], []
         
-        for chunk in chunks:
-            lines = chunk.strip().split('\n')
-            if not lines or not lines[0].startswith('# '):
-                continue
-            
-            title = lines[0].replace('# ', '').strip()
-            text = '\n'.join(lines[1:]).strip()
-            
-            doc = Document(
-                page_content=text,
-                metadata={
-                    "title": title,
-                    "source": path,
-                    "chunk_id": f"{title.lower().replace(' ', '_')}_{uuid.uuid4()}"
-                }
-            )
-            docs.append(doc)
+        with open(path, 'rb') as f:
+            # mmap cannot map an empty file
+            if os.fstat(f.fileno()).st_size == 0:
+                return texts, ids, metadatas
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # (start, end) of the separators, plus a sentinel for the tail after the last one
+                bounds = chain(((m.start(), m.end()) for m in CHUNK_SEPARATOR.finditer(mm)), [(len(mm), len(mm))])
+                start = 0
+                for end, next_start in bounds:
+                    chunk, start = mm[start:end], next_start
+                    match = CHUNK_TITLE.match(chunk.strip())
+                    if not match:
+                        continue
+                    
+                    title = match.group(1).decode('utf-8').strip()
+                    text = match.group(2).decode('utf-8').strip()
+                    chunk_id = RAGService._chunk_id(path, title, text)
+                    
+                    texts.append(text)
+                    ids.append(chunk_id)
+                    metadatas.append({"title": title, "source": path, "chunk_id": chunk_id})
         
-        return docs
+        return texts, ids, metadatas
     
-    def _ingest_markdown_files(self, directory):
+    def _ingest_markdown_files(self, directory, use_batch_api: bool = USE_BATCH_API):
         """Ingest all markdown files from directory."""
-        all_documents = []
+        texts, ids, metadatas = [], [], []
         
         # Check if directory exists
         if not os.path.exists(directory):
@@ -81,17 +207,114 @@ class RAGService:
             # Create sample rules.md file
             self._create_sample_rules(directory)
         
-        for filename in os.listdir(directory):
-            if filename.endswith('.md'):
-                file_path = os.path.join(directory, filename)
-                docs = self._chunk_markdown(file_path)
-                all_documents.extend(docs)
-                print(f"Processed {len(docs)} chunks from {filename}")
+        filenames = [filename for filename in os.listdir(directory) if filename.endswith('.md')]
+        paths = [os.path.join(directory, filename) for filename in filenames]
+        
+        # Parsing is CPU-bound; spread it over processes when there is more than one file
+        if len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+                chunked = list(executor.map(self._chunk_markdown, paths))
+        else:
+            chunked = [self._chunk_markdown(path) for path in paths]
         
-        if all_documents:
-            ids = [doc.metadata['chunk_id'] for doc in all_documents]
-            self.vector_store.add_documents(documents=all_documents, ids=ids)
-            print(f"Total ingested: {len(all_documents)} documents")
+        for filename, (file_texts, file_ids, file_metadatas) in zip(filenames, chunked):
+            texts += file_texts
+            ids += file_ids
+            metadatas += file_metadatas
+            print(f"Processed {len(file_texts)} chunks from {filename}")
+        
+        if not ids:
+            print("No chunks found to ingest")
+            return
+        
+        # Drop duplicate chunks and chunks already stored, so only new content is embedded
+        positions = {chunk_id: i for i, chunk_id in enumerate(ids)}
+        existing = self.vector_store._collection.get(ids=list(positions), include=[])["ids"]
+        for chunk_id in existing:
+            del positions[chunk_id]
+        if len(positions) < len(ids):
+            keep = sorted(positions.values())
+            texts = [texts[i] for i in keep]
+            ids = [ids[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+        
+        if not ids:
+            print("All chunks are already ingested")
+        else:
+            embeddings = None
+            if use_batch_api and len(texts) >= BATCH_API_MIN_CHUNKS:
+                try:
+                    embeddings = self._embed_with_batch_api(texts)
+                except Exception as e:
+                    print(f"Batch API embedding failed, embedding directly instead: {e}")
+            if embeddings is None:
+                embeddings = self._embed_texts(texts)
+            
+            # Embed up front so Chroma stores the vectors without embedding again
+            self.vector_store._collection.add(
+                ids=ids,
+                embeddings=embeddings,
+                documents=texts,
+                metadatas=metadatas
+            )
+            # Retrievals cached while embedding no longer reflect the collection
+            self._retrieval_cache.clear()
+            print(f"Total ingested: {len(ids)} documents")
+    
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in fixed-size batches, sending several batches concurrently."""
+        batches = [
+            texts[i:i + EMBEDDING_BATCH_SIZE]
+            for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+            return list(chain.from_iterable(executor.map(self.embeddings.embed_documents, batches)))
+    
+    def _embed_with_batch_api(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts with an OpenAI Batch API job and wait for it to complete."""
+        client = OpenAI()
+        batches = [
+            texts[i:i + EMBEDDING_BATCH_SIZE]
+            for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+        ]
+        requests = "\n".join(
+            json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {"model": EMBEDDING_MODEL, "input": batch, "dimensions": EMBEDDING_DIMENSIONS}
+            })
+            for i, batch in enumerate(batches)
+        )
+        
+        input_file = client.files.create(file=("embeddings.jsonl", requests.encode("utf-8")), purpose="batch")
+        batch_job = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h"
+        )
+        print(f"Submitted embedding batch {batch_job.id} for {len(texts)} chunks")
+        
+        while batch_job.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_API_POLL_INTERVAL)
+            batch_job = client.batches.retrieve(batch_job.id)
+        
+        if batch_job.status != "completed" or not batch_job.output_file_id:
+            raise RuntimeError(f"Embedding batch {batch_job.id} ended with status {batch_job.status}")
+        
+        # Output lines are unordered; reassemble by custom_id and embedding index
+        vectors = {}
+        for line in client.files.content(batch_job.output_file_id).text.splitlines():
+            record = json.loads(line)
+            response = record["response"]
+            if response["status_code"] != 200:
+                raise RuntimeError(f"Embedding request {record['custom_id']} failed: {response['body']}")
+            data = sorted(response["body"]["data"], key=lambda item: item["index"])
+            vectors[int(record["custom_id"])] = [item["embedding"] for item in data]
+        
+        if len(vectors) != len(batches):
+            raise RuntimeError(f"Embedding batch {batch_job.id} returned {len(vectors)} of {len(batches)} results")
+        return list(chain.from_iterable(vectors[i] for i in range(len(batches))))
     
     def _create_sample_rules(self, directory):
         """Create sample rules.md file."""
@@ -133,58 +356,26 @@ class RAGService:
             answer: str
             persona: str
         
-        def retrieve(state: State):
-            """Retrieve relevant documents."""
-            retrieved_docs = self.vector_store.similarity_search(
-                state["question"],
-                k=5
-            )
-            return {"context": retrieved_docs}
+        async def retrieve(state: State):
+            """Retrieve relevant documents, unless they were prefetched."""
+            if state.get("context") is not None:
+                return {}
+            return {"context": await self.aretrieve(state["question"])}
         
-        def generate(state: State):
+        async def generate(state: State):
             """Generate answer with persona."""
-            # Create persona-specific prompts
-            persona_prompts = {
-                "product_owner": """You are a technical product owner for a gaming platform. 
-                Focus on system architecture, performance metrics, and technical implementation details.
-                Discuss scalability, data structures, and engineering trade-offs when relevant.""",
-                
-                "marketing": """You are a marketing specialist for a gaming platform.
-                Focus on user experience, engagement metrics, and player satisfaction.
-                Use accessible language and highlight features that drive player retention and monetization."""
-            }
-            
-            system_prompt = persona_prompts.get(state.get("persona", "product_owner"))
-            
-            # Build context
-            enhanced_context = []
-            for doc in state["context"]:
-                title = doc.metadata.get("title", "Unknown")
-                content = doc.page_content
-                enhanced_context.append(f"Game: {title}\n{content}")
-            
-            full_context = "\n\n---\n\n".join(enhanced_context)
-            
-            prompt = PromptTemplate.from_template(
-                system_prompt + """
-                
-                Use the following game information to answer the question.
-                If the information doesn't contain the answer, say so clearly.
-                
-                Context:
-                {context}
-                
-                Question: {question}
-                
-                Answer:"""
-            )
+            prompt = self._answer_prompts.get(state.get("persona"), self._answer_prompts["product_owner"])
+            full_context = self._cap_tokens("\n\n---\n\n".join(
+                f"Game: {doc.metadata.get('title', 'Unknown')}\n{doc.page_content}"
+                for doc in state["context"]
+            ))
             
             messages = prompt.invoke({
                 "context": full_context,
                 "question": state["question"]
             })
             
-            response = self.llm.invoke(messages.to_string())
+            response = await self.llm.ainvoke(messages.to_string())
             return {"answer": response.content}
         
         # Build graph
@@ -197,12 +388,56 @@ class RAGService:
         
         return graph_builder.compile()
     
-    async def query_with_persona(self, question: str, persona: str = "product_owner") -> Dict[str, Any]:
-        """Query the RAG system with persona."""
-        result = await self.rag_app.ainvoke({
+    def _cap_tokens(self, text: str) -> str:
+        """Truncate text to MAX_CONTEXT_TOKENS tokens."""
+        tokens = self.tokenizer.encode(text)
+        if len(tokens) <= MAX_CONTEXT_TOKENS:
+            return text
+        return self.tokenizer.decode(tokens[:MAX_CONTEXT_TOKENS])
+    
+    async def aretrieve(self, question: str) -> List[Document]:
+        """Retrieve the documents relevant to a question without generating an answer."""
+        key = question.strip().lower()
+        if key in self._retrieval_cache:
+            return list(self._retrieval_cache[key])
+        
+        if not self._ready:
+            await asyncio.to_thread(self.warm_up)
+        
+        vector = self._query_embedding_cache.get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(question)
+            self._query_embedding_cache[key] = vector
+        
+        # Chroma returns distances; keep only the few chunks that are actually relevant
+        scored = await asyncio.to_thread(
+            self.vector_store.similarity_search_by_vector_with_relevance_scores,
+            vector,
+            k=RETRIEVAL_CANDIDATES
+        )
+        # The best hit is always kept: titles are not embedded, so a question naming a game
+        # can score low against the very chunk that answers it
+        relevance = self.vector_store._select_relevance_score_fn()
+        docs = [
+            doc for rank, (doc, distance) in enumerate(scored)
+            if rank == 0 or relevance(distance) > MIN_RELEVANCE_SCORE
+        ][:MAX_CONTEXT_DOCS]
+        self._retrieval_cache[key] = tuple(docs)
+        return docs
+    
+    def _initial_state(self, question: str, persona: str, context: Optional[List[Document]]) -> Dict[str, Any]:
+        state = {
             "question": question,
             "persona": persona
-        })
+        }
+        if context is not None:
+            state["context"] = context
+        return state
+    
+    async def query_with_persona(self, question: str, persona: str = "product_owner",
+                                 context: Optional[List[Document]] = None) -> Dict[str, Any]:
+        """Query the RAG system with persona, reusing prefetched context when given."""
+        result = await self.rag_app.ainvoke(self._initial_state(question, persona, context))
         
         return {
             "question": result["question"],
@@ -210,10 +445,29 @@ class RAGService:
             "context": result.get("context", [])
         }
     
+    async def astream_with_persona(self, question: str, persona: str = "product_owner",
+                                   context: Optional[List[Document]] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """Query the RAG system, yielding ("token", delta) as the answer is generated, then ("result", response)."""
+        result = self._initial_state(question, persona, context)
+        
+        async for mode, chunk in self.rag_app.astream(result, stream_mode=["messages", "values"]):
+            if mode == "values":
+                result = chunk
+                continue
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "generate" and message.content:
+                yield "token", message.content
+        
+        yield "result", {
+            "question": result["question"],
+            "answer": result["answer"],
+            "context": result.get("context", [])
+        }
+    
     def test_connection(self):
         """Test RAG service connection."""
         try:
-            test_results = self.vector_store.similarity_search("test", k=1)
+            self.vector_store._collection.count()
             return True
         except Exception as e:
             raise Exception(f"RAG service error: {str(e)}")
\ No newline at end of file
@@ -1,87 +1,85 @@
-import os
-from typing import TypedDict, Annotated, List, Dict, Any
-from langchain_community.utilities import SQLDatabase
+import re
+import asyncio
+import difflib
+from typing import TypedDict, List, Dict, Any, Optional, AsyncIterator, Tuple
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langgraph.graph import StateGraph, START
-from langgraph.prebuilt import create_react_agent
 import json
+from cachetools import TTLCache
+
+from src.database import DatabaseManager
+
+# Markdown code fence the LLM sometimes wraps the generated SQL in; the closing fence may be
+# missing, and a language tag only counts when a newline follows it (```SELECT ...``` has none)
+SQL_CODE_FENCE = re.compile(r"\A\s*```(?:[\w-]*[ \t]*\n)?\s*(.*?)\s*(?:```\s*)?\Z", re.S)
+
+# Only read-only queries are cached
+SELECT_QUERY = re.compile(r"\A\s*(?:SELECT|WITH)\b", re.I)
+
+# Columns of the products table, and the offending name in a sqlite "no such column" error.
+# The cutoff only accepts near-identical names (turnovr, contry); launch_year or segment_name
+# mean something else and are left to the LLM fix
+COLUMN_MATCH_CUTOFF = 0.85
+KNOWN_COLUMNS = ("id", "name", "description", "turnover", "launch_date", "country", "segment")
+NO_SUCH_COLUMN = re.compile(r"no such column: (?:\w+\.)?(\w+)", re.I)
+
+def repair_column_names(query: str, error: str) -> Optional[str]:
+    """Replace a misspelled column with the closest known one, or return None if that changes nothing."""
+    match = NO_SUCH_COLUMN.search(error)
+    if not match:
+        return None
+    column = match.group(1)
+    candidates = difflib.get_close_matches(column.lower(), KNOWN_COLUMNS, n=1, cutoff=COLUMN_MATCH_CUTOFF)
+    if not candidates:
+        return None
+    repaired = re.sub(rf"\b{re.escape(column)}\b", candidates[0], query)
+    # An unchanged query would only fail the same way again
+    return repaired if repaired != query else None
+
+# Persona instructions folded into the answer prompt, so no separate rewrite call is needed
+PERSONA_PROMPTS = {
+    "product_owner": """You are answering for a technical product owner. Shape the answer to:
+    - Emphasize system architecture and technical implementation details
+    - Discuss performance implications and trade-offs
+    - Include metrics and data-driven insights
+    - Use technical terminology appropriately
+    - Focus on scalability and system design considerations""",
+    
+    "marketing": """You are answering for a marketing specialist. Shape the answer to:
+    - Highlight user experience and engagement metrics
+    - Focus on conversion rates and customer value
+    - Use persuasive and accessible language
+    - Emphasize benefits and opportunities
+    - Include actionable insights for marketing strategies"""
+}
 
 class QueryState(TypedDict):
     """State for the SQL query workflow."""
     question: str
+    persona: str
     query: str
     result: str
+    rows: List[Dict[str, Any]]
     answer: str
     error: str
 
 class SQLQueryAgent:
-    def __init__(self, db_path: str = "db/products.db", model: str = "o4-mini"):
-        """Initialize the SQL Query Agent."""
-        self.db = SQLDatabase.from_uri(f"sqlite:///{db_path}")
+    def __init__(self, db_manager: Optional[DatabaseManager] = None, model: str = "o4-mini"):
+        """Initialize the SQL Query Agent on the in-memory copy of the products database."""
+        self.db_manager = db_manager or DatabaseManager()
         self.llm = ChatOpenAI(model=model, temperature=1)
-        self.setup_tools()
-        self.setup_workflow()
-    
-    def setup_tools(self):
-        """Set up SQL database tools."""
-        self.toolkit = SQLDatabaseToolkit(db=self.db, llm=self.llm)
-        self.tools = self.toolkit.get_tools()
-        
-        # Direct query execution tool
-        self.query_tool = QuerySQLDatabaseTool(db=self.db)
-    
-    def setup_workflow(self):
-        """Set up the LangGraph workflow."""
-        # Create workflow
-        workflow = StateGraph(QueryState)
-        
-        # Add nodes
-        workflow.add_node("analyze_question", self.analyze_question)
-        workflow.add_node("generate_query", self.generate_query)
-        workflow.add_node("execute_query", self.execute_query)
-        workflow.add_node("generate_answer", self.generate_answer)
-        
-        # Add edges
-        workflow.add_edge(START, "analyze_question")
-        workflow.add_edge("analyze_question", "generate_query")
-        workflow.add_edge("generate_query", "execute_query")
-        workflow.add_edge("execute_query", "generate_answer")
         
-        # Compile workflow
-        self.app = workflow.compile()
-    
-    def analyze_question(self, state: QueryState) -> QueryState:
-        """Analyze the question to understand what data is needed."""
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a SQL expert analyzing questions about a products database.
-            The database has a 'products' table with columns:
-            - id (INTEGER): Product ID
-            - name (TEXT): Product name It is a unique identifier for each product. Product is nothing but a game playable in a casino. name can called as a product, game or name
-            - description (TEXT): Product description
-            - turnover (REAL): Product turnover/revenue
-            - launch_date (DATE): Product launch date
-            - country (TEXT): Country where product is available
-            - segment (TEXT): Market segment (Low, Medium, High)
-            
-            Analyze the user's question and identify:
-            1. What data they're looking for
-            2. Any filters needed (country, date range, segment, etc.)
-            3. Any aggregations needed (sum, average, count, group by)
-            4. Any sorting or limiting needed
-            """),
-            ("human", "{question}")
-        ])
+        # Normalized question -> SQL that ran successfully, and SELECT query -> rows
+        self._question_sql_cache = TTLCache(maxsize=512, ttl=3600)
+        self._query_result_cache = TTLCache(maxsize=512, ttl=60)
         
-        response = self.llm.invoke(prompt.format(question=state["question"]))
-        return state
+        self.setup_prompts()
+        self.setup_workflow()
     
-    def generate_query(self, state: QueryState) -> QueryState:
-        """Generate SQL query from the question."""
-        prompt = ChatPromptTemplate.from_messages([
+    def setup_prompts(self):
+        """Build the prompt templates once, instead of on every query."""
+        self._generate_query_prompt = ChatPromptTemplate.from_messages([
             ("system", """You are a SQL expert. Generate a SQLite query for the products table.
             
             Table schema:
@@ -106,83 +104,153 @@ class SQLQueryAgent:
             ("human", "Generate a SQL query for: {question}")
         ])
         
-        response = self.llm.invoke(prompt.format(question=state["question"]))
+        self._fix_query_prompt = ChatPromptTemplate.from_messages([
+            ("system", """Fix the SQL query based on the error. 
+            Common fixes:
+            - Column names are case-sensitive
+            - Date comparisons need proper formatting
+            - Table name is 'products' (lowercase)
+            
+            Return ONLY the fixed SQL query."""),
+            ("human", "Query: {query}\nError: {error}")
+        ])
+        
+        # One answer prompt per persona
+        self._answer_prompts = {
+            persona: ChatPromptTemplate.from_messages([
+                ("system", """You are a helpful assistant that explains SQL query results in natural language.
+                Given a question, SQL query, and results, provide a clear, concise answer.
+                
+                Guidelines:
+                - Explain what the data shows
+                - Highlight key findings
+                - Use proper formatting for numbers and dates
+                - If the result is empty, explain that no data matches the criteria
+                
+                """ + persona_prompt),
+                ("human", """Question: {question}
+                SQL Query: {query}
+                Results: {result}
+                
+                Please provide a natural language answer. Don't make the response too long, be concise and to the point.""")
+            ])
+            for persona, persona_prompt in PERSONA_PROMPTS.items()
+        }
+    
+    def setup_workflow(self):
+        """Set up the LangGraph workflow."""
+        # Create workflow
+        workflow = StateGraph(QueryState)
+        
+        # Add nodes
+        workflow.add_node("generate_query", self.generate_query)
+        workflow.add_node("execute_query", self.execute_query)
+        workflow.add_node("generate_answer", self.generate_answer)
+        
+        # Add edges
+        workflow.add_edge(START, "generate_query")
+        workflow.add_edge("generate_query", "execute_query")
+        workflow.add_edge("execute_query", "generate_answer")
+        
+        # Compile workflow
+        self.app = workflow.compile()
+    
+    async def generate_query(self, state: QueryState) -> QueryState:
+        """Generate SQL query from the question."""
+        cached_query = self._question_sql_cache.get(state["question"].strip().lower())
+        if cached_query:
+            state["query"] = cached_query
+            return state
+        
+        response = await self.llm.ainvoke(self._generate_query_prompt.format(question=state["question"]))
         query = response.content.strip()
         
-        # Clean up the query
-        if query.startswith("```sql"):
-            query = query[6:]
-        if query.endswith("```"):
-            query = query[:-3]
+        # Clean up the query, unwrapping any markdown code fence (```sql, ```SQL, ```sqlite, ...)
+        match = SQL_CODE_FENCE.match(query)
+        if match:
+            query = match.group(1)
         query = query.strip()
         
         state["query"] = query
         return state
     
-    def execute_query(self, state: QueryState) -> QueryState:
+    def run_query(self, query: str) -> List[Dict[str, Any]]:
+        """Execute a SQL query directly on the shared SQLite connection and return the rows as dicts."""
+        return self.db_manager.execute_read(query)
+    
+    def _store_rows(self, state: QueryState, rows: List[Dict[str, Any]]):
+        """Store rows in the state, plus the textual form used in the answer prompt."""
+        state["rows"] = rows
+        state["result"] = json.dumps(rows, default=str) if rows else ""
+        state["error"] = ""
+    
+    def _cache_results(self, state: QueryState, remember_question: bool = True):
+        """For read-only queries, remember the SQL generated for the question and its rows."""
+        if not SELECT_QUERY.match(state["query"]):
+            return
+        if remember_question:
+            self._question_sql_cache[state["question"].strip().lower()] = state["query"]
+        self._query_result_cache[state["query"]] = state["rows"]
+    
+    async def execute_query(self, state: QueryState) -> QueryState:
         """Execute the SQL query."""
+        cached_rows = self._query_result_cache.get(state["query"])
+        if cached_rows is not None:
+            self._store_rows(state, cached_rows)
+            return state
+        
         try:
-            result = self.query_tool.invoke(state["query"])
-            state["result"] = result
-            state["error"] = ""
+            self._store_rows(state, await asyncio.to_thread(self.run_query, state["query"]))
+            self._cache_results(state)
         except Exception as e:
             state["error"] = str(e)
             state["result"] = ""
+            state["rows"] = []
             
             # Try to fix common errors
             if "no such column" in str(e).lower():
-                # Retry with fixed column names
-                fixed_query = self.fix_query(state["query"], str(e))
+                # Retry with fixed column names: a local spelling repair first, the LLM only if that fails
+                local_query = repair_column_names(state["query"], str(e))
+                if local_query is not None and await self._retry_query(state, local_query):
+                    return state
+                
+                fixed_query = await self.fix_query(state["query"], str(e))
                 try:
-                    result = self.query_tool.invoke(fixed_query)
+                    self._store_rows(state, await asyncio.to_thread(self.run_query, fixed_query))
                     state["query"] = fixed_query
-                    state["result"] = result
                     state["error"] = ""
+                    self._cache_results(state)
                 except Exception as e2:
                     state["error"] = f"Original error: {e}\nRetry error: {e2}"
         
         return state
     
-    def fix_query(self, query: str, error: str) -> str:
+    async def _retry_query(self, state: QueryState, query: str) -> bool:
+        """Run a locally repaired query, keeping it in the state if it succeeds."""
+        try:
+            self._store_rows(state, await asyncio.to_thread(self.run_query, query))
+        except Exception:
+            return False
+        state["query"] = query
+        state["error"] = ""
+        # A guessed repair is not reused for the question; the next ask regenerates the SQL
+        self._cache_results(state, remember_question=False)
+        return True
+    
+    async def fix_query(self, query: str, error: str) -> str:
         """Attempt to fix common SQL errors."""
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """Fix the SQL query based on the error. 
-            Common fixes:
-            - Column names are case-sensitive
-            - Date comparisons need proper formatting
-            - Table name is 'products' (lowercase)
-            
-            Return ONLY the fixed SQL query."""),
-            ("human", "Query: {query}\nError: {error}")
-        ])
-        
-        response = self.llm.invoke(prompt.format(query=query, error=error))
+        response = await self.llm.ainvoke(self._fix_query_prompt.format(query=query, error=error))
         return response.content.strip()
     
-    def generate_answer(self, state: QueryState) -> QueryState:
+    async def generate_answer(self, state: QueryState) -> QueryState:
         """Generate natural language answer from query results."""
         if state.get("error"):
             state["answer"] = f"I encountered an error while processing your query: {state['error']}"
             return state
         
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful assistant that explains SQL query results in natural language.
-            Given a question, SQL query, and results, provide a clear, concise answer.
-            
-            Guidelines:
-            - Explain what the data shows
-            - Highlight key findings
-            - Use proper formatting for numbers and dates
-            - If the result is empty, explain that no data matches the criteria
-            """),
-            ("human", """Question: {question}
-            SQL Query: {query}
-            Results: {result}
-            
-            Please provide a natural language answer. Don't make the response too long, be concise and to the point.""")
-        ])
+        prompt = self._answer_prompts.get(state.get("persona"), self._answer_prompts["product_owner"])
         
-        response = self.llm.invoke(prompt.format(
+        response = await self.llm.ainvoke(prompt.format(
             question=state["question"],
             query=state["query"],
             result=state["result"]
@@ -191,24 +259,22 @@ class SQLQueryAgent:
         state["answer"] = response.content
         return state
     
-    def process_query(self, question: str) -> Dict[str, Any]:
-        """Process a natural language query and return results."""
-        initial_state = {
+    def _initial_state(self, question: str, persona: str) -> QueryState:
+        return {
             "question": question,
+            "persona": persona,
             "query": "",
             "result": "",
+            "rows": [],
             "answer": "",
             "error": ""
         }
-        
-        # Run the workflow
-        final_state = self.app.invoke(initial_state)
-        
-        # Format response
+    
+    def _format_response(self, final_state: QueryState) -> Dict[str, Any]:
         response = {
             "question": final_state["question"],
             "sql_query": final_state["query"],
-            "raw_results": final_state["result"],
+            "raw_results": final_state["rows"],
             "answer": final_state["answer"]
         }
         
@@ -216,4 +282,29 @@ class SQLQueryAgent:
             response["error"] = final_state["error"]
         
         return response
-
+    
+    async def process_query(self, question: str, persona: str = "product_owner") -> Dict[str, Any]:
+        """Process a natural language query and return results answered for the persona."""
+        final_state = await self.app.ainvoke(self._initial_state(question, persona))
+        return self._format_response(final_state)
+    
+    async def astream_query(self, question: str, persona: str = "product_owner") -> AsyncIterator[Tuple[str, Any]]:
+        """Process a query, yielding ("token", delta) as the answer is generated, then ("result", response)."""
+        final_state = self._initial_state(question, persona)
+        streamed = False
+        
+        async for mode, chunk in self.app.astream(final_state, stream_mode=["messages", "values"]):
+            if mode == "values":
+                final_state = chunk
+                continue
+            # Only the answer is user-facing; query generation and repair stream too
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "generate_answer" and message.content:
+                streamed = True
+                yield "token", message.content
+        
+        # Error answers are set without calling the LLM, so nothing was streamed
+        if not streamed and final_state["answer"]:
+            yield "token", final_state["answer"]
+        
+        yield "result", self._format_response(final_state)